@@ -1,20 +1,142 @@
 import json
 import boto3
+import functools
+import logging
 import os
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import unquote_plus
-from requests_aws4auth import AWS4Auth
-import requests
+from opensearchpy import AWSV4SignerAuth, JSONSerializer, OpenSearch, RequestsHttpConnection, helpers
+
+try:
+    import orjson
+except ImportError:  # fall back to stdlib json when orjson is not packaged
+    orjson = None
+
+if orjson:
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+
+    class OrjsonSerializer(JSONSerializer):
+        """JSONSerializer backed by orjson for OpenSearch request and response bodies"""
+
+        def dumps(self, data):
+            if isinstance(data, str):
+                return data
+            return orjson.dumps(data, default=self.default).decode()
+
+        def loads(self, s):
+            return orjson.loads(s)
+
+    opensearch_serializer = OrjsonSerializer()
+else:
+    json_dumps = json.dumps
+    opensearch_serializer = JSONSerializer()
 
 # in index-photos folder run and upload to console zip -r deployment-package.zip .
 
 s3_client = boto3.client('s3')
 rekognition_client = boto3.client('rekognition')
 
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+# opensearch-py logs every request at INFO; keep only its warnings and errors
+logging.getLogger('opensearch').setLevel(logging.WARNING)
+
 OPENSEARCH_ENDPOINT = os.environ.get('OPENSEARCH_ENDPOINT', '')
 OPENSEARCH_INDEX = 'photos'
 AWS_REGION = 'us-east-1'
 SERVICE = 'es'
+MAX_WORKERS = 8
+LABEL_CACHE_SIZE = 1024
+INGEST_PIPELINE = 'photos-index'
+BACKFILL_PIPELINE = 'photos-backfill'
+
+# Splits the (lowercased) labels into distinct single words in labelTokens,
+# so the search Lambda's single-word keywords match multi-word labels
+# ("palm tree" -> "palm", "tree") with an analyzer-free terms query.
+LABEL_TOKENS_SCRIPT = {'script': {'source': (
+    "Set tokens = new LinkedHashSet();"
+    " if (ctx.labels != null) { for (String label : ctx.labels) {"
+    " StringBuilder word = new StringBuilder();"
+    " for (int i = 0; i <= label.length(); i++) {"
+    " if (i < label.length() && Character.isLetter(label.charAt(i))) { word.append(label.charAt(i)); }"
+    " else if (word.length() > 0) { tokens.add(word.toString()); word = new StringBuilder(); }"
+    " } } }"
+    " ctx.labelTokens = new ArrayList(tokens);"
+)}}
+
+# Runs inside OpenSearch on every indexed photo: merges custom labels into
+# labels, lowercases and dedupes them, splits them into labelTokens and
+# stamps the creation time.
+PIPELINE_BODY = {
+    'description': 'Merge, lowercase, dedupe and tokenize photo labels; set createdTimestamp',
+    'processors': [
+        {'lowercase': {'field': 'labels', 'ignore_missing': True}},
+        {'lowercase': {'field': 'customLabels', 'ignore_missing': True}},
+        {'script': {'source': (
+            "Set merged = new LinkedHashSet(ctx.labels);"
+            " if (ctx.customLabels != null) { merged.addAll(ctx.customLabels); ctx.remove('customLabels'); }"
+            " ctx.labels = new ArrayList(merged);"
+        )}},
+        LABEL_TOKENS_SCRIPT,
+        {'set': {'field': 'createdTimestamp', 'value': '{{_ingest.timestamp}}'}}
+    ]
+}
+
+# Used once by the 'migrate' action on documents indexed before labelTokens
+# existed. Unlike PIPELINE_BODY it leaves createdTimestamp untouched.
+BACKFILL_PIPELINE_BODY = {
+    'description': 'Lowercase and tokenize labels of existing photos',
+    'processors': [
+        {'lowercase': {'field': 'labels', 'ignore_missing': True}},
+        LABEL_TOKENS_SCRIPT
+    ]
+}
+
+# Explicit mapping applied when the index is first created.
+# objectKey/bucket are exact-match identifiers, so keyword avoids text analysis.
+INDEX_BODY = {
+    'mappings': {
+        'properties': {
+            'objectKey': {'type': 'keyword'},
+            'bucket': {'type': 'keyword'},
+            'createdTimestamp': {'type': 'date'},
+            'labels': {
+                'type': 'text',
+                'fields': {'keyword': {'type': 'keyword', 'ignore_above': 256}}
+            },
+            # Target of the search Lambda's terms query
+            'labelTokens': {'type': 'keyword'}
+        }
+    }
+}
+
+# Documents indexed before labelTokens existed
+BACKFILL_QUERY = {
+    'query': {
+        'bool': {
+            'must': {'exists': {'field': 'labels'}},
+            'must_not': {'exists': {'field': 'labelTokens'}}
+        }
+    }
+}
+
+# Built once per container so warm invocations reuse the signer and keep-alive connections
+credentials = boto3.Session().get_credentials()
+opensearch_client = OpenSearch(
+    hosts=[OPENSEARCH_ENDPOINT],
+    http_auth=AWSV4SignerAuth(credentials, AWS_REGION, SERVICE),
+    use_ssl=True,
+    verify_certs=True,
+    connection_class=RequestsHttpConnection,
+    serializer=opensearch_serializer,
+    http_compress=True,
+    timeout=5,
+    max_retries=3,
+    retry_on_timeout=True
+) if OPENSEARCH_ENDPOINT else None
+pipeline_ready = False
+index_ready = False
 
 def lambda_handler(event, context):
     """
@@ -22,12 +144,16 @@ def lambda_handler(event, context):
     
     For S3 events: Index photos uploaded to S3
     For manual invocation: Query OpenSearch (use event['action'] = 'query')
+    For one-off migration: Backfill labelTokens (use event['action'] = 'migrate')
     """
     
     # Check if this is a query request (manual invocation)
     if event.get('action') == 'query':
         return handle_query(event, context)
     
+    if event.get('action') == 'migrate':
+        return handle_migration(event, context)
+    
     # Otherwise, handle S3 indexing (original functionality)
     return handle_s3_indexing(event, context)
 
@@ -36,37 +162,59 @@ def handle_query(event, context):
     if not OPENSEARCH_ENDPOINT:
         return {
             'statusCode': 400,
-            'body': json.dumps('OpenSearch endpoint not configured')
+            'body': json_dumps('OpenSearch endpoint not configured')
         }
     
     try:
-        credentials = boto3.Session().get_credentials()
-        awsauth = AWS4Auth(
-            credentials.access_key,
-            credentials.secret_key,
-            AWS_REGION,
-            SERVICE,
-            session_token=credentials.token
-        )
-        
         query_type = event.get('queryType', 'count')
         
         if query_type == 'count':
-            url = f"{OPENSEARCH_ENDPOINT}/{OPENSEARCH_INDEX}/_count"
-            response = requests.get(url, auth=awsauth)
+            result = opensearch_client.count(index=OPENSEARCH_INDEX, filter_path='count')
         elif query_type == 'all':
-            url = f"{OPENSEARCH_ENDPOINT}/{OPENSEARCH_INDEX}/_search"
             query = {"query": {"match_all": {}}, "size": 10}
-            response = requests.post(url, auth=awsauth, json=query, headers={'Content-Type': 'application/json'})
+            result = opensearch_client.search(index=OPENSEARCH_INDEX, body=query)
         else:
-            return {'statusCode': 400, 'body': json.dumps('Invalid queryType')}
+            return {'statusCode': 400, 'body': json_dumps('Invalid queryType')}
+        
+        return {
+            'statusCode': 200,
+            'body': json_dumps(result)
+        }
+    except Exception as e:
+        return {'statusCode': 500, 'body': json_dumps(f'Query error: {str(e)}')}
+
+def handle_migration(event, context):
+    """
+    Add labelTokens to an index created before it was part of INDEX_BODY
+    and backfill it on existing documents as a background task.
+    Run once per domain; new photos get labelTokens from the ingest pipeline.
+    """
+    if not OPENSEARCH_ENDPOINT:
+        return {
+            'statusCode': 400,
+            'body': json_dumps('OpenSearch endpoint not configured')
+        }
+    
+    try:
+        opensearch_client.indices.put_mapping(
+            index=OPENSEARCH_INDEX,
+            body={'properties': {'labelTokens': INDEX_BODY['mappings']['properties']['labelTokens']}}
+        )
+        opensearch_client.ingest.put_pipeline(id=BACKFILL_PIPELINE, body=BACKFILL_PIPELINE_BODY)
+        result = opensearch_client.update_by_query(
+            index=OPENSEARCH_INDEX,
+            body=BACKFILL_QUERY,
+            pipeline=BACKFILL_PIPELINE,
+            conflicts='proceed',
+            wait_for_completion=False
+        )
         
         return {
             'statusCode': 200,
-            'body': json.dumps(response.json() if response.status_code == 200 else response.text)
+            'body': json_dumps(result)
         }
     except Exception as e:
-        return {'statusCode': 500, 'body': json.dumps(f'Query error: {str(e)}')}
+        return {'statusCode': 500, 'body': json_dumps(f'Migration error: {str(e)}')}
 
 def handle_s3_indexing(event, context):
     """
@@ -76,105 +224,159 @@ def handle_s3_indexing(event, context):
     1. Extract S3 event details (bucket, key)
     2. Use Rekognition to detect labels
     3. Retrieve custom labels from S3 object metadata
-    4. Index photo metadata in OpenSearch
+    4. Index photo metadata in OpenSearch (one bulk request per event)
+    
+    Records are processed concurrently since each one is I/O bound.
     """
     
-    print(f"Received event: {json.dumps(event)}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Received event: %s", json_dumps(event))
     
     try:
-        # Parse S3 event
-        for record in event['Records']:
-            # Get bucket and object key from event
-            bucket = record['s3']['bucket']['name']
-            key = unquote_plus(record['s3']['object']['key'])
-            
-            print(f"Processing image: s3://{bucket}/{key}")
-            
-            # Step 1: Detect labels using Rekognition
-            labels = detect_labels(bucket, key)
-            print(f"Detected labels from Rekognition: {labels}")
-            
-            # Step 2: Get custom labels from S3 metadata
-            custom_labels = get_custom_labels(bucket, key)
-            print(f"Custom labels from metadata: {custom_labels}")
-            
-            # Step 3: Combine all labels
-            all_labels = labels + custom_labels
-            print(f"Combined labels: {all_labels}")
-            
-            # Step 4: Create photo document for indexing
-            photo_document = {
-                'objectKey': key,
-                'bucket': bucket,
-                'createdTimestamp': datetime.now().isoformat(),
-                'labels': all_labels
-            }
-            
-            print(f"Photo document prepared: {json.dumps(photo_document)}")
-            
-            # Step 5: Index in OpenSearch
-            if OPENSEARCH_ENDPOINT:
-                index_photo(photo_document)
-                print(f"Photo indexed in OpenSearch: {key}")
-            else:
-                print("OpenSearch endpoint not configured.")
+        records = event['Records']
+        
+        # Cap workers to stay well within Rekognition TPS quotas
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(records) or 1)) as executor:
+            actions = list(executor.map(process_record, records))
+        
+        # Step 5: Index all photos in a single bulk request
+        if OPENSEARCH_ENDPOINT:
+            index_photos(actions)
+        else:
+            logger.warning("OpenSearch endpoint not configured.")
         
         return {
             'statusCode': 200,
-            'body': json.dumps('Photo(s) processed successfully')
+            'body': json_dumps('Photo(s) processed successfully')
         }
         
     except Exception as e:
-        print(f"Error processing image: {str(e)}")
+        logger.error("Error processing image: %s", e)
         raise e
 
 
-def detect_labels(bucket, key):
+def process_record(record):
+    """
+    Detect and collect labels for a single S3 record.
+    
+    Args:
+        record (dict): S3 event record
+        
+    Returns:
+        dict: Bulk 'create' action for the photo document
+    """
+    # Get bucket and object key from event
+    bucket = record['s3']['bucket']['name']
+    key = unquote_plus(record['s3']['object']['key'])
+    
+    logger.info("Processing image: s3://%s/%s", bucket, key)
+    
+    # Steps 1 and 2 are independent, so the S3 HEAD runs alongside Rekognition.
+    # The event's ETag keys the label cache without waiting for the HEAD.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # Step 1: Get custom labels and ETag from S3 metadata
+        metadata_future = executor.submit(get_custom_labels, bucket, key)
+        
+        # Step 2: Detect labels using Rekognition (cached by ETag)
+        labels = detect_labels(bucket, key, record['s3']['object'].get('eTag', ''))
+        
+        custom_labels, etag = metadata_future.result()
+    
+    logger.debug("Custom labels from metadata: %s", custom_labels)
+    logger.debug("Detected labels from Rekognition: %s", labels)
+    
+    # Step 3: Create photo document for indexing. The ingest pipeline merges,
+    # lowercases and dedupes the labels and sets createdTimestamp.
+    photo_document = {
+        'objectKey': key,
+        'bucket': bucket,
+        'labels': labels,
+        'customLabels': custom_labels
+    }
+    
+    logger.debug("Photo document prepared: %s", photo_document)
+    
+    # Step 4: Build bulk action for OpenSearch.
+    # Content hash as document ID + 'create' rejects duplicate photos.
+    # Single-part ETags are the object's MD5, so no extra S3 read is needed.
+    if etag and '-' not in etag:
+        content_hash = etag
+    else:
+        content_hash = get_photo_hash(bucket, key)
+    
+    return {
+        '_op_type': 'create',
+        '_index': OPENSEARCH_INDEX,
+        '_id': f"photo_{content_hash}",
+        '_source': photo_document
+    }
+
+
+def detect_labels(bucket, key, etag=''):
     """
     Use AWS Rekognition to detect labels in the image.
+    Labels are cached per container by ETag, so S3 event retries and
+    re-uploads of the same object skip Rekognition.
     
     Args:
         bucket (str): S3 bucket name
         key (str): S3 object key
+        etag (str): S3 object ETag, caching is skipped when empty
         
     Returns:
         list: List of detected label names with confidence > 70%
     """
     try:
-        response = rekognition_client.detect_labels(
-            Image={
-                'S3Object': {
-                    'Bucket': bucket,
-                    'Name': key
-                }
-            },
-            MaxLabels=10,
-            MinConfidence=70.0
-        )
-        
-        # Extract label names from response
-        labels = [label['Name'] for label in response['Labels']]
-        return labels
+        if etag:
+            labels = detect_labels_by_etag(etag, bucket, key)
+        else:
+            labels = detect_labels_by_etag.__wrapped__(etag, bucket, key)
+        return list(labels)
         
     except Exception as e:
-        print(f"Error detecting labels with Rekognition: {str(e)}")
+        logger.error("Error detecting labels with Rekognition: %s", e)
         return []
 
 
+@functools.lru_cache(maxsize=LABEL_CACHE_SIZE)
+def detect_labels_by_etag(etag, bucket, key):
+    """
+    Call Rekognition for an object version. Errors propagate so that
+    failed lookups are never cached.
+    
+    Returns:
+        tuple: Detected label names (immutable, as it is shared via the cache)
+    """
+    response = rekognition_client.detect_labels(
+        Image={
+            'S3Object': {
+                'Bucket': bucket,
+                'Name': key
+            }
+        },
+        MaxLabels=10,
+        MinConfidence=70.0
+    )
+    
+    # Extract label names from response
+    return tuple(label['Name'] for label in response['Labels'])
+
+
 def get_custom_labels(bucket, key):
     """
-    Retrieve custom labels from S3 object metadata.
+    Retrieve custom labels and ETag from S3 object metadata.
     
     Args:
         bucket (str): S3 bucket name
         key (str): S3 object key
         
     Returns:
-        list: List of custom labels from metadata
+        tuple: List of custom labels from metadata, object ETag without quotes
     """
     try:
         response = s3_client.head_object(Bucket=bucket, Key=key)
         metadata = response.get('Metadata', {})
+        etag = response.get('ETag', '').strip('"')
         
         # Look for x-amz-meta-customLabels in metadata
         custom_labels_str = metadata.get('customlabels', '')
@@ -182,18 +384,19 @@ def get_custom_labels(bucket, key):
         if custom_labels_str:
             # Split comma-separated labels and strip whitespace
             custom_labels = [label.strip() for label in custom_labels_str.split(',')]
-            return custom_labels
+            return custom_labels, etag
         
-        return []
+        return [], etag
         
     except Exception as e:
-        print(f"Error retrieving custom labels from S3 metadata: {str(e)}")
-        return []
+        logger.error("Error retrieving custom labels from S3 metadata: %s", e)
+        return [], ''
 
 
 def get_photo_hash(bucket, key):
     """
     Generate content hash for duplicate detection.
+    Only used when the ETag is missing or from a multipart upload.
     Uses first 1KB of file for performance.
     """
     import hashlib
@@ -207,69 +410,78 @@ def get_photo_hash(bucket, key):
         content = response['Body'].read()
         return hashlib.md5(content).hexdigest()[:12]  # 12-char hash
     except Exception as e:
-        print(f"Error generating hash: {str(e)}")
+        logger.error("Error generating hash: %s", e)
         # Fallback to filename-based ID if hash fails
         return key.replace('/', '_').replace('.', '_')
 
 
-def index_photo(photo_document):
+def index_photos(actions):
     """
-    Index photo document in OpenSearch.
-    Uses content hash to prevent duplicate photos.
+    Bulk index photo documents in OpenSearch.
+    Actions use op_type 'create', so photos whose content hash is
+    already indexed are rejected instead of overwritten.
     
     Args:
-        photo_document (dict): Photo metadata to index
+        actions (list): Bulk actions, one per photo document
+        
+    Returns:
+        int: Number of newly indexed photos
+        
+    Raises:
+        RuntimeError: If any photo failed for a reason other than being a
+            duplicate, so the invocation fails and S3 retries the event
     """
-    if not OPENSEARCH_ENDPOINT:
-        print("OpenSearch endpoint not configured")
+    if not actions:
+        return 0
+    
+    ensure_index()
+    
+    success, errors = helpers.bulk(
+        opensearch_client,
+        actions,
+        raise_on_error=False,
+        pipeline=INGEST_PIPELINE
+    )
+    
+    # 409 means the document ID already exists: a duplicate photo
+    failed = 0
+    for error in errors:
+        result = error.get('create', {})
+        if result.get('status') == 409:
+            logger.info("Duplicate photo detected! Document ID: %s", result.get('_id'))
+        else:
+            failed += 1
+            logger.error("Failed to index photo %s: %s", result.get('_id'), result.get('error'))
+    
+    logger.info("Bulk indexed %d new photo(s)", success)
+    if failed:
+        raise RuntimeError(f"Failed to index {failed} photo(s) in OpenSearch")
+    return success
+
+
+def ensure_index():
+    """
+    Create the ingest pipeline and the photos index once per container.
+    The pipeline PUT is idempotent; an existing index
+    (400 resource_already_exists) is left untouched. Indexes created before
+    labelTokens existed are upgraded by the 'migrate' action.
+    
+    Raises:
+        Exception: If the pipeline cannot be created, since every bulk
+            request depends on it
+    """
+    global pipeline_ready, index_ready
+    
+    if not pipeline_ready:
+        opensearch_client.ingest.put_pipeline(id=INGEST_PIPELINE, body=PIPELINE_BODY)
+        pipeline_ready = True
+    
+    if index_ready:
         return
     
+    # Indexing still works with a dynamic mapping, so failures here are only logged
     try:
-        # Get AWS credentials from Lambda execution role
-        credentials = boto3.Session().get_credentials()
-        awsauth = AWS4Auth(
-            credentials.access_key,
-            credentials.secret_key,
-            AWS_REGION,
-            SERVICE,
-            session_token=credentials.token
-        )
-        
-        # Use content hash as document ID to prevent duplicate photos
-        content_hash = get_photo_hash(photo_document['bucket'], photo_document['objectKey'])
-        document_id = f"photo_{content_hash}"
-        
-        # Check if this photo content already exists
-        check_url = f"{OPENSEARCH_ENDPOINT}/{OPENSEARCH_INDEX}/_doc/{document_id}"
-        check_response = requests.head(check_url, auth=awsauth)
-        
-        if check_response.status_code == 200:
-            print(f"Duplicate photo detected! Content hash: {content_hash}")
-            print(f"Photo {photo_document['objectKey']} is identical to existing photo")
-            return False  # Don't index duplicates
-        
-        url = f"{OPENSEARCH_ENDPOINT}/{OPENSEARCH_INDEX}/_doc/{document_id}"
-        
-        headers = {'Content-Type': 'application/json'}
-        
-        # Index the document (will update if exists)
-        response = requests.put(
-            url,
-            auth=awsauth,
-            json=photo_document,
-            headers=headers
-        )
-        
-        print(f"OpenSearch response: {response.status_code}")
-        print(f"Response body: {response.text}")
-        
-        if response.status_code in [200, 201]:
-            print(f"New photo indexed with content hash: {content_hash}")
-            return True
-        else:
-            print(f"Failed to index photo: {response.status_code}")
-            return False
-        
+        opensearch_client.indices.create(index=OPENSEARCH_INDEX, body=INDEX_BODY, ignore=400)
+        index_ready = True
     except Exception as e:
-        print(f"Error indexing photo in OpenSearch: {str(e)}")
-        return False
+        logger.error("Error creating OpenSearch index: %s", e)
@@ -1,114 +1,224 @@
 import json
 import boto3
+import logging
 import os
-import requests
-from requests_aws4auth import AWS4Auth
+import re
+from opensearchpy import AWSV4SignerAuth, JSONSerializer, OpenSearch, RequestsHttpConnection
 
+try:
+    import orjson
+except ImportError:  # fall back to stdlib json when orjson is not packaged
+    orjson = None
+
+if orjson:
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+
+    class OrjsonSerializer(JSONSerializer):
+        """JSONSerializer backed by orjson for OpenSearch request and response bodies"""
+
+        def dumps(self, data):
+            if isinstance(data, str):
+                return data
+            return orjson.dumps(data, default=self.default).decode()
+
+        def loads(self, s):
+            return orjson.loads(s)
+
+    opensearch_serializer = OrjsonSerializer()
+else:
+    json_dumps = json.dumps
+    opensearch_serializer = JSONSerializer()
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+# opensearch-py logs every request at INFO; keep only its warnings and errors
+logging.getLogger('opensearch').setLevel(logging.WARNING)
 
 OPENSEARCH_ENDPOINT = os.environ.get('OPENSEARCH_ENDPOINT', '')
 OPENSEARCH_INDEX = 'photos'
 SERVICE = 'es'
 AWS_REGION = 'us-east-1'
-STOP_WORDS = {'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'with', 'by', 'show', 'me', 'find', 'search', 'photos', 'pictures', 'images'}
+S3_URL_SUFFIX = f"s3.{AWS_REGION}.amazonaws.com"
+# Per-search options that let OpenSearch reuse cached shard results
+MSEARCH_HEADER = {'preference': '_local', 'request_cache': True}
+LEX_BOT_ID = os.environ.get('LEX_BOT_ID', '')
+LEX_BOT_ALIAS_ID = os.environ.get('LEX_BOT_ALIAS_ID', 'TSTALIASID')
+LEX_LOCALE_ID = 'en_US'
+LEX_SESSION_ID = 'search-session'
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Content-Type': 'application/json'
+}
+# Prebuilt so rejected requests skip building and serializing the body
+MISSING_QUERY_RESPONSE = {
+    'statusCode': 400,
+    'headers': CORS_HEADERS,
+    'body': json_dumps({'error': 'Query parameter q is required'})
+}
+STOP_WORDS = frozenset({'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'with', 'by', 'show', 'me', 'find', 'search', 'photos', 'pictures', 'images'})
+# One pass blanks out stop words and every non-letter run, leaving only keywords.
+# [^\W\d_] is any Unicode letter, so accented words like "café" stay whole;
+# lookarounds rather than \b, which treats digits and '_' as word characters.
+KEYWORD_CLEANER = re.compile(
+    r"(?<![^\W\d_])(?:" + "|".join(map(re.escape, sorted(STOP_WORDS))) + r")(?![^\W\d_])|[\W\d_]+"
+)
+# (suffix, replacement, minimum word length), checked in order
+PLURAL_SUFFIXES = (
+    ('ies', 'y', 5),     # puppies -> puppy, berries -> berry
+    ('sses', 'ss', 5),   # glasses -> glass
+    ('ches', 'ch', 5),   # beaches -> beach
+    ('shes', 'sh', 5),   # dishes -> dish
+    ('xes', 'x', 4),     # boxes -> box
+    ('zes', 'z', 4),     # buzzes -> buzz
+    ('ss', 'ss', 4),     # grass, dress stay singular
+    ('s', '', 4),        # dogs -> dog, cats -> cat
+)
+
+# Built once per container so warm invocations reuse the signer and keep-alive connections
+credentials = boto3.Session().get_credentials()
+opensearch_client = OpenSearch(
+    hosts=[OPENSEARCH_ENDPOINT],
+    http_auth=AWSV4SignerAuth(credentials, AWS_REGION, SERVICE),
+    use_ssl=True,
+    verify_certs=True,
+    connection_class=RequestsHttpConnection,
+    serializer=opensearch_serializer,
+    http_compress=True,
+    timeout=5,
+    max_retries=3,
+    retry_on_timeout=True
+) if OPENSEARCH_ENDPOINT else None
+lex_client = boto3.client('lexv2-runtime', region_name=AWS_REGION)
 
 def normalize_plural(word):
     """Convert plural words to singular form"""
-    if len(word) <= 3:
-        return word
-    
-    # Handle common plural patterns
-    if word.endswith('ies') and len(word) > 4:
-        return word[:-3] + 'y'  # puppies -> puppy, berries -> berry
-    elif word.endswith('es') and len(word) > 3:
-        if word.endswith(('ches', 'shes', 'xes', 'zes', 'sses')):
-            return word[:-2]  # beaches -> beach, boxes -> box
-    elif word.endswith('s') and len(word) > 3:
-        return word[:-1]  # dogs -> dog, cats -> cat, beasts -> beast
-    
+    # First matching suffix decides; words shorter than its minimum are kept
+    for suffix, replacement, min_length in PLURAL_SUFFIXES:
+        if word.endswith(suffix):
+            if len(word) < min_length:
+                return word
+            return word[:-len(suffix)] + replacement
     return word
 
 def extract_keywords_from_text(text):
     """Extract keywords from text by removing stop words and normalizing plurals"""
-    words = text.lower().split()
-    keywords = [word.strip('.,!?') for word in words if word not in STOP_WORDS and len(word) > 2]
-    # Normalize plurals to singular
-    return [normalize_plural(kw) for kw in keywords]
+    return [
+        normalize_plural(word) for word in KEYWORD_CLEANER.sub(' ', text.lower()).split()
+        if len(word) > 2
+    ]
 
+def build_search_query(keywords):
+    """Build the OpenSearch query for one list of keywords"""
+    # Keywords are already lowercased single words, so match them exactly
+    # against labelTokens, the per-word split of each label made by the
+    # index pipeline. constant_score skips scoring, so identical searches are
+    # served from the shard request cache.
+    return {
+        "query": {
+            "constant_score": {
+                "filter": {"terms": {"labelTokens": keywords}}
+            }
+        },
+        "_source": ["bucket", "objectKey", "labels"],
+        "size": 50  # Maximum number of results
+    }
+
+def parse_search_hits(results_data):
+    """Convert an OpenSearch search response into photo objects"""
+    hits = results_data.get('hits', {}).get('hits', [])
+    return [
+        {
+            'url': f"https://{source.get('bucket', '')}.{S3_URL_SUFFIX}/{source.get('objectKey', '')}",
+            'labels': source.get('labels', [])
+        }
+        for source in (hit['_source'] for hit in hits)
+    ]
 
 def search_photos_in_opensearch(keywords):
     """
     Search OpenSearch for photos with matching labels
     
     Args:
-        keywords: List of keywords to search for
+        keywords: List of keywords to search for, or a list of such lists
+            to run several searches in a single _msearch round trip
         
     Returns:
-        List of photo objects with url and labels
+        List of photo objects with url and labels, or one such list per
+        keyword list when several were given
     """
     if not keywords:
         return []
     
+    if isinstance(keywords[0], list):
+        return search_photos_in_opensearch_batch(keywords)
+    
     if not OPENSEARCH_ENDPOINT:
-        print("OpenSearch endpoint not configured")
+        logger.warning("OpenSearch endpoint not configured")
         return []
     
     try:
-        session = boto3.Session()
-        credentials = session.get_credentials()
-        awsauth = AWS4Auth(
-            credentials.access_key,
-            credentials.secret_key,
-            AWS_REGION,
-            SERVICE,
-            session_token=credentials.token
-        )
-        
         # Build OpenSearch query
-        query = {
-            "query": {
-                "bool": {
-                    "should": [
-                        {"match": {"labels": keyword}} for keyword in keywords
-                    ],
-                    "minimum_should_match": 1
-                }
-            },
-            "size": 50  # Maximum number of results
-        }
+        query = build_search_query(keywords)
         
         # Make request to OpenSearch
-        url = f"{OPENSEARCH_ENDPOINT}/{OPENSEARCH_INDEX}/_search"
-        headers = {"Content-Type": "application/json"}
+        logger.debug("Searching OpenSearch with query: %s", query)
+        results_data = opensearch_client.search(
+            index=OPENSEARCH_INDEX,
+            body=query,
+            filter_path='hits.hits._source',
+            preference='_local',
+            request_cache=True
+        )
         
-        print(f"Searching OpenSearch with query: {json.dumps(query)}")
-        response = requests.post(url, auth=awsauth, headers=headers, json=query)
-        response.raise_for_status()
+        results = parse_search_hits(results_data)
+        logger.info("Found %d photos", len(results))
+        return results
         
-        results_data = response.json()
-        print(f"OpenSearch response: {json.dumps(results_data)}")
+    except Exception as e:
+        logger.error("Error searching OpenSearch: %s", e)
+        return []
+
+def search_photos_in_opensearch_batch(keyword_lists):
+    """
+    Run one search per keyword list with a single _msearch request
+    
+    Args:
+        keyword_lists: List of keyword lists
         
-        # Parse results
-        results = []
-        hits = results_data.get('hits', {}).get('hits', [])
+    Returns:
+        List of photo object lists, in the same order as keyword_lists
+    """
+    if not OPENSEARCH_ENDPOINT:
+        logger.warning("OpenSearch endpoint not configured")
+        return [[] for _ in keyword_lists]
+    
+    try:
+        # msearch body alternates header and query lines
+        body = []
+        for keywords in keyword_lists:
+            body.append(MSEARCH_HEADER)
+            body.append(build_search_query(keywords))
         
-        for hit in hits:
-            source = hit['_source']
-            bucket = source.get('bucket', '')
-            object_key = source.get('objectKey', '')
-            
-            s3_url = f"https://{bucket}.s3.{AWS_REGION}.amazonaws.com/{object_key}"
-            
-            results.append({
-                'url': s3_url,
-                'labels': source.get('labels', [])
-            })
+        logger.debug("Multi-searching OpenSearch with body: %s", body)
+        results_data = opensearch_client.msearch(
+            index=OPENSEARCH_INDEX,
+            body=body,
+            # status keeps every response entry, so results stay aligned with queries
+            filter_path='responses.status,responses.error,responses.hits.hits._source'
+        )
         
-        print(f"Found {len(results)} photos")
+        results = []
+        for i, search_response in enumerate(results_data.get('responses', [])):
+            if search_response.get('status') != 200:
+                logger.error("Error in multi-search query %d: %s", i, search_response.get('error'))
+            results.append(parse_search_hits(search_response))
+        logger.info("Found %s photos", [len(photos) for photos in results])
         return results
         
     except Exception as e:
-        print(f"Error searching OpenSearch: {e}")
-        return []
+        logger.error("Error multi-searching OpenSearch: %s", e)
+        return [[] for _ in keyword_lists]
     
 
 def lambda_handler(event, context):
@@ -120,7 +230,8 @@ def lambda_handler(event, context):
     2. From Lex fulfillment (processes Lex response)
     """
     
-    print(f"Received event: {json.dumps(event)}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Received event: %s", json_dumps(event))
     
     # Check if this is coming from Lex (fulfillment)
     if 'sessionState' in event and 'intent' in event.get('sessionState', {}):
@@ -138,41 +249,29 @@ def handle_api_search(event, context):
         user_query = query_params.get('q', '').strip()
         
         if not user_query:
-            return {
-                'statusCode': 400,
-                'headers': {
-                    'Access-Control-Allow-Origin': '*',
-                    'Content-Type': 'application/json'
-                },
-                'body': json.dumps({
-                    'error': 'Query parameter q is required'
-                })
-            }
+            return MISSING_QUERY_RESPONSE
         
-        print(f"User query: {user_query}")
+        logger.info("User query: %s", user_query)
         
         # Send query to Lex for processing
         lex_response = query_lex_bot(user_query)
         
         if not lex_response:
             # Fallback: extract keywords directly from query
-            print("Lex response is empty, using direct keyword extraction")
+            logger.info("Lex response is empty, using direct keyword extraction")
             keywords = extract_keywords_from_text(user_query)
         else:
             # Extract keywords from Lex response
             keywords = extract_keywords_from_lex_response(lex_response)
-            print(f"Extracted keywords from Lex: {keywords}")
+            logger.info("Extracted keywords from Lex: %s", keywords)
         
         # If still no keywords, return empty results
         if not keywords:
-            print("No keywords extracted from query")
+            logger.info("No keywords extracted from query")
             return {
                 'statusCode': 200,
-                'headers': {
-                    'Access-Control-Allow-Origin': '*',
-                    'Content-Type': 'application/json'
-                },
-                'body': json.dumps({
+                'headers': CORS_HEADERS,
+                'body': json_dumps({
                     'query': user_query,
                     'keywords': [],
                     'results': []
@@ -184,25 +283,19 @@ def handle_api_search(event, context):
 
         return {
             'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Content-Type': 'application/json'
-            },
-            'body': json.dumps({
+            'headers': CORS_HEADERS,
+            'body': json_dumps({
                 'query': user_query,
                 'keywords': keywords,
                 'results': search_results
             })
         }
     except Exception as e:
-        print(f"Error in handle_api_search: {e}")
+        logger.error("Error in handle_api_search: %s", e)
         return {
             'statusCode': 500,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Content-Type': 'application/json'
-            },
-            'body': json.dumps({
+            'headers': CORS_HEADERS,
+            'body': json_dumps({
                 'error': str(e)
             })
         }
@@ -219,7 +312,7 @@ def extract_keywords_from_lex_response(lex_response):
                 return keywords
             
     except Exception as e:
-        print(f"Error extracting keywords from Lex response: {str(e)}")
+        logger.error("Error extracting keywords from Lex response: %s", e)
     
     return []
 
@@ -228,30 +321,23 @@ def extract_keywords_from_lex_response(lex_response):
 def query_lex_bot(user_input):
     """Send user query to Lex bot"""
     try:
-        lex_client = boto3.client('lexv2-runtime', region_name=AWS_REGION)
-        
-        bot_id = os.environ.get('LEX_BOT_ID', '')
-        bot_alias_id = os.environ.get('LEX_BOT_ALIAS_ID', 'TSTALIASID')
-        locale_id = 'en_US'
-        session_id = 'search-session'
-        
-        if not bot_id:
-            print("LEX_BOT_ID not configured, skipping Lex")
+        if not LEX_BOT_ID:
+            logger.warning("LEX_BOT_ID not configured, skipping Lex")
             return None
         
         response = lex_client.recognize_text(
-            botId=bot_id,
-            botAliasId=bot_alias_id,
-            localeId=locale_id,
-            sessionId=session_id,
+            botId=LEX_BOT_ID,
+            botAliasId=LEX_BOT_ALIAS_ID,
+            localeId=LEX_LOCALE_ID,
+            sessionId=LEX_SESSION_ID,
             text=user_input
         )
         
-        print(f"Lex response: {json.dumps(response)}")
+        logger.debug("Lex response: %s", response)
         return response
         
     except Exception as e:
-        print(f"Error querying Lex: {str(e)}")
+        logger.error("Error querying Lex: %s", e)
         return None
 
 def text_message(content):
@@ -265,8 +351,7 @@ def response(session_state, messages=None, session_attributes=None):
         body["messages"] = messages
     return body
 
-def close(event, fulfillment_state, message, session_attributes=None):
-    intent = event["sessionState"]["intent"]
+def close(intent, fulfillment_state, message, session_attributes=None):
     intent["state"] = fulfillment_state  # "Fulfilled" | "Failed"
     return response(
         session_state={
@@ -278,27 +363,28 @@ def close(event, fulfillment_state, message, session_attributes=None):
     )
 
 def handle_lex_fulfillment(event, context):
-    print(f"Received event: {json.dumps(event)}")
+    # lambda_handler only routes here when sessionState.intent is present
+    intent = event['sessionState']['intent']
     try:
         # Extract keywords from Lex response
-        intent_name = event['sessionState']['intent']['name']
-        slots = event['sessionState']['intent']['slots']
+        intent_name = intent['name']
+        slots = intent['slots']
         input_transcript = event.get('inputTranscript', '')
 
         if intent_name == 'FallbackIntent':
-            return close(event, "Fulfilled", "Sorry, I didn’t quite get that.")
+            return close(intent, "Fulfilled", "Sorry, I didn’t quite get that.")
         
-        print(f"Intent: {intent_name}, Input: {input_transcript}, Slots: {slots}")
+        logger.info("Intent: %s, Input: %s, Slots: %s", intent_name, input_transcript, slots)
 
         keywords = extract_keywords_from_slots(slots)
 
-        print(f"Extracted keywords: {keywords}")
+        logger.info("Extracted keywords: %s", keywords)
 
-        return close(event, "Fulfilled", f"Searching for photos with keywords: {', '.join(keywords)}", session_attributes={
-            'results': json.dumps(keywords)
+        return close(intent, "Fulfilled", f"Searching for photos with keywords: {', '.join(keywords)}", session_attributes={
+            'results': json_dumps(keywords)
         })
     except Exception as e:
-        return close(event, "Failed", f"Error processing request: {str(e)}")
+        return close(intent, "Failed", f"Error processing request: {str(e)}")
 
 def extract_keywords_from_slots(slots):
     """Extract keywords from Lex slots"""